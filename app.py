@@ -1,19 +1,56 @@
 import streamlit as st
 import datetime
 import pandas as pd
+import matplotlib
+matplotlib.use("Agg")
 import matplotlib.pyplot as plt
-from sqlalchemy import create_engine, Column, Integer, String, Date, Float, ForeignKey
-from sqlalchemy.orm import declarative_base, sessionmaker, relationship
+from sqlalchemy import create_engine, delete, func, event, insert, select, Column, Integer, String, Date, Float, ForeignKey, Index
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import declarative_base, scoped_session, sessionmaker, relationship, selectinload
 import bcrypt
 from st_aggrid import AgGrid, GridUpdateMode
 import calendar as cal
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from fpdf import FPDF
 
 # ---------------- DATABASE SETUP ----------------
 Base = declarative_base()
-engine = create_engine("sqlite:///expense_app.db", echo=False)
-Session = sessionmaker(bind=engine)
-session = Session()
+
+def _sqlite_pragmas(dbapi_conn, _):
+    dbapi_conn.execute("PRAGMA journal_mode=WAL")
+    dbapi_conn.execute("PRAGMA synchronous=NORMAL")
+
+# Streamlit re-executes this script on every interaction, so anything
+# process-wide lives behind st.cache_resource and is built only once
+@st.cache_resource
+def get_engine():
+    engine = create_engine(
+        "sqlite:///expense_app.db",
+        echo=False,
+        connect_args={"check_same_thread": False},
+        pool_size=5,
+        pool_pre_ping=True
+    )
+    event.listen(engine, "connect", _sqlite_pragmas)
+    return engine
+
+@st.cache_resource
+def get_session_factory():
+    # objects stay readable after commit since helpers hand them back detached
+    return scoped_session(sessionmaker(bind=get_engine(), expire_on_commit=False))
+
+@st.cache_resource
+def get_hash_pool():
+    # bcrypt runs off the script thread so reruns aren't pinned during hashing
+    return ThreadPoolExecutor(max_workers=2)
+
+engine = get_engine()
+Session = get_session_factory()
+_HASH_POOL = get_hash_pool()
+
+logger = logging.getLogger(__name__)
 
 # ---------------- TABLES ----------------
 class User(Base):
@@ -35,6 +72,7 @@ class Expense(Base):
     amount = Column(Float)
     note = Column(String)
     user = relationship("User", back_populates="expenses")
+    __table_args__ = (Index("ix_expense_user_date", "user_id", "date"),)
 
 class Salary(Base):
     __tablename__ = "salary"
@@ -43,79 +81,173 @@ class Salary(Base):
     month = Column(String)  # YYYY-MM
     salary = Column(Float)
     user = relationship("User", back_populates="salaries")
+    __table_args__ = (Index("ix_salary_user_month", "user_id", "month", unique=True),)
+
+@st.cache_resource
+def _init_db():
+    Base.metadata.create_all(engine)
+    # older databases may hold duplicate salary rows from the old check-then-insert;
+    # keep the first one per month (the one lookups already returned) so the
+    # unique index below can be built
+    with engine.begin() as conn:
+        dup_months = conn.execute(
+            select(func.count()).select_from(
+                select(Salary.user_id)
+                .group_by(Salary.user_id, Salary.month)
+                .having(func.count() > 1)
+                .subquery()
+            )
+        ).scalar()
+        if dup_months:
+            keep = select(func.min(Salary.id)).group_by(Salary.user_id, Salary.month)
+            deleted = conn.execute(delete(Salary).where(Salary.id.not_in(keep))).rowcount
+            logger.warning(
+                "Removed %d duplicate salary rows across %d (user_id, month) pairs "
+                "before creating ix_salary_user_month",
+                deleted, dup_months
+            )
+    # create_all skips existing tables, so add the indexes to older databases too
+    for index in (*Expense.__table__.indexes, *Salary.__table__.indexes):
+        index.create(engine, checkfirst=True)
+    return engine
 
-Base.metadata.create_all(engine)
+_init_db()
 
 # ---------------- HELPERS ----------------
+def bcrypt_rounds():
+    try:
+        return int(st.secrets.get("BCRYPT_ROUNDS", 10))
+    except FileNotFoundError:
+        return 10
+
 def register_user(name, email, password):
-    hashed = bcrypt.hashpw(password.encode(), bcrypt.gensalt())
+    salt = bcrypt.gensalt(rounds=bcrypt_rounds())
+    hashed = _HASH_POOL.submit(bcrypt.hashpw, password.encode(), salt).result()
     new_user = User(name=name, email=email, password=hashed)
-    session.add(new_user)
-    session.commit()
+    with Session() as s:
+        s.add(new_user)
+        s.commit()
+
+def user_exists(email):
+    with Session() as s:
+        return s.query(User.id).filter_by(email=email).first() is not None
 
 def authenticate_user(email, password):
-    user = session.query(User).filter_by(email=email).first()
-    if user and bcrypt.checkpw(password.encode(), user.password):
+    with Session() as s:
+        user = s.query(User).options(selectinload(User.salaries)).filter_by(email=email).first()
+    if user and _HASH_POOL.submit(bcrypt.checkpw, password.encode(), user.password).result():
         return user
     return None
 
+# the data caches are process-wide, so their versions must be too; a
+# per-session counter would let a fresh session hit another's old entries
+@st.cache_resource
+def _expense_versions():
+    return {}, threading.Lock()
+
+def expense_version(user_id):
+    versions, _ = _expense_versions()
+    return versions.get(user_id, 0)
+
+def bump_expense_version(user_id):
+    versions, lock = _expense_versions()
+    with lock:
+        versions[user_id] = versions.get(user_id, 0) + 1
+
 def save_expense(user_id, date, category, amount, note):
-    new_exp = Expense(user_id=user_id, date=date, category=category, amount=amount, note=note)
-    session.add(new_exp)
-    session.commit()
+    save_expenses_bulk(user_id, [{"date": date, "category": category, "amount": amount, "note": note}])
 
-def save_salary(user_id, month, salary):
-    exists = session.query(Salary).filter_by(user_id=user_id, month=month).first()
-    if exists:
+def save_expenses_bulk(user_id, rows):
+    if not rows:
+        return
+    with Session() as s:
+        s.execute(insert(Expense), [{**row, "user_id": user_id} for row in rows])
+        s.commit()
+    bump_expense_version(user_id)
+
+def update_expenses(user_id, mappings):
+    if not mappings:
+        return
+    with Session() as s:
+        s.bulk_update_mappings(Expense, mappings)
+        s.commit()
+    bump_expense_version(user_id)
+
+def changed_expense_rows(orig_df, updated_df):
+    cols = ["Date", "Category", "Amount", "Note"]
+    merged = updated_df.merge(orig_df, on="ID", suffixes=("", "_old"))
+    new_vals = merged[cols]
+    old_vals = merged[[f"{c}_old" for c in cols]].set_axis(cols, axis=1)
+    same = new_vals.eq(old_vals) | (new_vals.isna() & old_vals.isna())
+    return merged[~same.all(axis=1)][["ID"] + cols]
+
+def save_salary(user, month, salary):
+    if any(sal.month == month for sal in user.salaries):
+        st.warning("Salary already fixed for this month")
+        return
+    stmt = sqlite_insert(Salary).values(user_id=user.id, month=month, salary=salary)
+    with Session() as s:
+        s.add(user)
+        result = s.execute(stmt.on_conflict_do_nothing(index_elements=["user_id", "month"]))
+        s.commit()
+        s.refresh(user, ["salaries"])
+    if result.rowcount == 0:
         st.warning("Salary already fixed for this month")
         return
-    new_sal = Salary(user_id=user_id, month=month, salary=salary)
-    session.add(new_sal)
-    session.commit()
     st.success("Salary saved in database ✅")
 
-def get_monthly_salary(user_id, month=None):
+def get_monthly_salary(user, month=None):
     if not month:
         month = datetime.date.today().strftime("%Y-%m")
-    sal = session.query(Salary).filter_by(user_id=user_id, month=month).first()
-    return sal.salary if sal else 0.0
-
-def get_month_expenses(user_id, year, month):
-    records = session.query(Expense).filter(
+    return next((s.salary for s in user.salaries if s.month == month), 0.0)
+
+# version is part of the cache key so any write for the user invalidates it
+@st.cache_data(ttl=300)
+def get_month_expenses(user_id, year, month, version=0):
+    stmt = select(
+        Expense.date.label("Date"),
+        Expense.category.label("Category"),
+        Expense.amount.label("Amount"),
+        Expense.note.label("Note"),
+        Expense.id.label("ID")
+    ).where(
         Expense.user_id == user_id,
         Expense.date.between(
             datetime.date(year, month, 1),
             datetime.date(year, month, cal.monthrange(year, month)[1])
         )
-    ).all()
-
-    data = []
-    for r in records:
-        data.append({
-            "Date": r.date.strftime("%Y-%m-%d"),  # ✅ FIX
-            "Category": r.category,
-            "Amount": r.amount,
-            "Note": r.note,
-            "ID": r.id
-        })
+    )
 
-    return pd.DataFrame(data)
+    df = pd.read_sql(stmt, engine, parse_dates=["Date"])
+    df["Date"] = df["Date"].dt.strftime("%Y-%m-%d")
+    return df
 
 
-def monthly_summary(user_id, year=None, month=None):
+def monthly_summary(user, year=None, month=None, version=None):
     if not year or not month:
         today = datetime.date.today()
         year, month = today.year, today.month
-
-    df = get_month_expenses(user_id, year, month)
+    if version is None:
+        version = expense_version(user.id)
+
+    salary = get_monthly_salary(user, f"{year}-{month:02d}")
+    return _monthly_summary(user.id, year, month, salary, version)
+
+# keyed on the salary value and the process-wide expense version, so reruns
+# that change neither (e.g. a download click) skip the groupbys entirely,
+# and a write from any session invalidates the summary for every session
+@st.cache_data(ttl=300)
+def _monthly_summary(user_id, year, month, salary, version):
+    df = get_month_expenses(user_id, year, month, version)
     if df.empty:
         return None
 
     total_expense = df["Amount"].sum()
-    salary = get_monthly_salary(user_id, f"{year}-{month:02d}")
     remaining = salary - total_expense
-    category_summary = df.groupby("Category")["Amount"].sum().to_dict()
-    max_category = max(category_summary, key=category_summary.get) if category_summary else None
+    # daily_sum keeps the default sort so the trend plots in date order
+    daily_sum = df.groupby("Date")["Amount"].sum()
+    category_summary = df.groupby("Category", sort=False)["Amount"].sum()
+    max_category = category_summary.idxmax() if not category_summary.empty else None
 
     return {
         "total_expense": total_expense,
@@ -123,31 +255,33 @@ def monthly_summary(user_id, year=None, month=None):
         "remaining": remaining,
         "max_category": max_category,
         "category_summary": category_summary,
+        "daily_sum": daily_sum,
         "df": df
     }
 
 # ---------------- GRAPHS ----------------
-def show_graphs(df):
-    daily = df.groupby("Date")["Amount"].sum()
+def show_graphs(daily, category):
     st.markdown("### 📈 Daily Expense Trend")
-    plt.figure(figsize=(8,4))
-    daily.plot(marker='o')
-    plt.xlabel("Date")
-    plt.ylabel("Amount")
-    st.pyplot(plt)
+    fig, ax = plt.subplots(figsize=(8,4))
+    daily.plot(ax=ax, marker='o')
+    ax.set_xlabel("Date")
+    ax.set_ylabel("Amount")
+    st.pyplot(fig)
+    plt.close(fig)
 
-    category = df.groupby("Category")["Amount"].sum()
     st.markdown("### 📊 Category-wise Expense")
-    plt.figure(figsize=(6,4))
-    category.plot(kind="bar", color="skyblue")
-    plt.ylabel("Amount")
-    st.pyplot(plt)
+    fig, ax = plt.subplots(figsize=(6,4))
+    category.plot(kind="bar", color="skyblue", ax=ax)
+    ax.set_ylabel("Amount")
+    st.pyplot(fig)
+    plt.close(fig)
 
     st.markdown("### 🥧 Expense Distribution by Category")
-    plt.figure(figsize=(6,6))
-    category.plot(kind="pie", autopct='%1.1f%%', startangle=90)
-    plt.ylabel("")
-    st.pyplot(plt)
+    fig, ax = plt.subplots(figsize=(6,6))
+    category.plot(kind="pie", autopct='%1.1f%%', startangle=90, ax=ax)
+    ax.set_ylabel("")
+    st.pyplot(fig)
+    plt.close(fig)
 
 # ---------------- SUMMARY ----------------
 def show_summary(summary):
@@ -159,9 +293,8 @@ def show_summary(summary):
 
 # ---------------- ADVANCED INSIGHTS ----------------
 def advanced_insights(month_summary):
-    df = month_summary["df"]
-    if df.empty: return
-    daily_sum = df.groupby("Date")["Amount"].sum()
+    daily_sum = month_summary["daily_sum"]
+    if daily_sum.empty: return
     st.markdown("### 🔎 Advanced Insights")
     st.write(f"Average daily spend: Rs.{daily_sum.mean():.2f}")
     st.write(f"Highest spending day: {daily_sum.idxmax()} → Rs.{daily_sum.max()}")
@@ -169,12 +302,10 @@ def advanced_insights(month_summary):
 
 # ---------------- ALERTS ----------------
 def show_alerts(month_summary):
-    df = month_summary["df"]
-    if df.empty: return
+    daily = month_summary["daily_sum"]
+    if daily.empty: return
 
-    avg_daily = df.groupby("Date")["Amount"].sum().mean()
-    high_days = df.groupby("Date")["Amount"].sum()
-    high_days = high_days[high_days > avg_daily]
+    high_days = daily[daily > daily.mean()]
     if not high_days.empty:
         st.warning(f"⚠️ High spending days: {', '.join(high_days.index.astype(str))}")
 
@@ -182,23 +313,28 @@ def show_alerts(month_summary):
         st.warning("⚠️ Remaining salary is below 10%!")
 
 # ---------------- PDF EXPORT ----------------
-def export_pdf(user_name, month_summary, filename="monthly_report.pdf"):
+# keyed on the same small tuple as the summary, which it reads back from
+# the _monthly_summary cache so the PDF always matches its key
+@st.cache_data(ttl=300, max_entries=100, show_spinner=False)
+def export_pdf(user_name, user_id, year, month, salary, version):
+    month_summary = _monthly_summary(user_id, year, month, salary, version)
     pdf = FPDF()
     pdf.add_page()
-    pdf.set_font("Arial", "B", 16)
-    pdf.cell(0, 10, f"{user_name} - Monthly Expense Report", 0, 1, "C")
-    pdf.set_font("Arial", "", 12)
-    pdf.ln(5)
-    pdf.cell(0, 10, f"Salary: Rs.{month_summary['salary']}", 0, 1)
-    pdf.cell(0, 10, f"Total Expenses: Rs.{month_summary['total_expense']}", 0, 1)
-    pdf.cell(0, 10, f"Remaining Salary: Rs.{month_summary['remaining']}", 0, 1)
-    pdf.cell(0, 10, f"Highest Spending Category: {month_summary['max_category']}", 0, 1)
-    pdf.ln(5)
-    pdf.cell(0, 10, "Category-wise Expenses:", 0, 1)
-    for cat, amt in month_summary['category_summary'].items():
-        pdf.cell(0, 10, f"{cat}: Rs.{amt}", 0, 1)
-    pdf.output(filename)
-    return filename
+    pdf.set_font("Helvetica", "B", 16)
+    pdf.cell(0, 10, f"{user_name} - Monthly Expense Report", new_x="LMARGIN", new_y="NEXT", align="C")
+    pdf.set_font("Helvetica", "", 12)
+    pdf.ln(10)
+    header = (
+        f"Salary: Rs.{month_summary['salary']}\n"
+        f"Total Expenses: Rs.{month_summary['total_expense']}\n"
+        f"Remaining Salary: Rs.{month_summary['remaining']}\n"
+        f"Highest Spending Category: {month_summary['max_category']}\n"
+        "\n"
+        "Category-wise Expenses:"
+    )
+    body = "\n".join(f"{cat}: Rs.{amt:.2f}" for cat, amt in month_summary['category_summary'].items())
+    pdf.multi_cell(0, 10, f"{header}\n{body}", new_x="LMARGIN", new_y="NEXT")
+    return bytes(pdf.output())
 
 # ---------------- SESSION ----------------
 if "logged_in" not in st.session_state:
@@ -231,8 +367,7 @@ if not st.session_state.logged_in:
     with col2:
         if st.button("Register"):
             if email and password and name:
-                existing = session.query(User).filter_by(email=email).first()
-                if existing:
+                if user_exists(email):
                     st.error("User already exists. Login instead.")
                 else:
                     register_user(name, email, password)
@@ -261,7 +396,7 @@ else:
         today = datetime.date.today()
         year = st.selectbox("Year", [today.year-1, today.year, today.year+1], index=1)
         month = st.selectbox("Month", list(range(1,13)), index=today.month-1)
-        df_month = get_month_expenses(user.id, year, month)
+        df_month = get_month_expenses(user.id, year, month, expense_version(user.id))
 
         if not df_month.empty:
             st.markdown("### Edit / Delete Expenses")
@@ -272,25 +407,31 @@ else:
                 fit_columns_on_grid_load=True
             )
             updated_df = grid_response['data']
-            for idx, row in updated_df.iterrows():
-                exp = session.query(Expense).filter_by(id=int(row['ID'])).first()
-                if exp:
-                    exp.date = datetime.datetime.strptime(row["Date"], "%Y-%m-%d").date()
-
-                    exp.category = row['Category']
-                    exp.amount = row['Amount']
-                    exp.note = row['Note']
-            session.commit()
-            st.success("Expenses updated successfully ✅")
+            changed = changed_expense_rows(df_month, updated_df)
+            if not changed.empty:
+                dates = pd.to_datetime(changed["Date"], format="%Y-%m-%d", cache=True).dt.date.to_numpy()
+                update_expenses(user.id, [
+                    {
+                        "id": int(r.ID),
+                        "date": d,
+                        "category": r.Category,
+                        "amount": float(r.Amount),
+                        "note": r.Note
+                    }
+                    for r, d in zip(changed.itertuples(), dates)
+                ])
+                st.success("Expenses updated successfully ✅")
         else:
             st.info("No expenses for this month yet.")
 
         st.markdown("### Add New Expense")
-        new_date = st.date_input("Date", datetime.date.today())
-        new_cat = st.text_input("Category")
-        new_amt = st.number_input("Amount", min_value=0.0, step=1.0)
-        new_note = st.text_input("Note")
-        if st.button("Add Expense"):
+        with st.form("add_expense", clear_on_submit=True):
+            new_date = st.date_input("Date", datetime.date.today())
+            new_cat = st.text_input("Category")
+            new_amt = st.number_input("Amount", min_value=0.0, step=1.0)
+            new_note = st.text_input("Note")
+            submitted = st.form_submit_button("Add Expense")
+        if submitted:
             save_expense(user.id, new_date, new_cat, new_amt, new_note)
             st.success("Expense added ✅")
             st.rerun()
@@ -299,27 +440,29 @@ else:
     elif menu == "Salary":
         st.subheader("💼 Salary")
         month_str = datetime.date.today().strftime("%Y-%m")
-        salary = get_monthly_salary(user.id, month_str)
+        salary = get_monthly_salary(user, month_str)
         if salary > 0:
             st.success(f"Salary: Rs.{salary}")
         else:
             sal = st.number_input("Enter salary", min_value=0.0, step=1000.0)
             if st.button("Fix Salary"):
-                save_salary(user.id, month_str, sal)
+                save_salary(user, month_str, sal)
 
     # ---------------- REPORTS ----------------
     elif menu == "Reports":
         st.subheader("📊 Full Dashboard & Insights")
         today = datetime.date.today()
         year, month = today.year, today.month
-        summary = monthly_summary(user.id, year, month)
+        # read once so the summary and PDF are built from the same version
+        version = expense_version(user.id)
+        summary = monthly_summary(user, year, month, version)
 
         if not summary:
             st.info("No expenses for this month yet!")
         else:
             show_summary(summary)
             show_alerts(summary)
-            show_graphs(summary["df"])
+            show_graphs(summary["daily_sum"], summary["category_summary"])
             advanced_insights(summary)
 
             # CSV Export
@@ -332,9 +475,13 @@ else:
             )
 
             # PDF Export
-            pdf_file = export_pdf(user.name, summary, f"{year}-{month:02d}_report.pdf")
-            with open(pdf_file, "rb") as f:
-                st.download_button("Download PDF Report", f, f"{year}-{month:02d}_report.pdf")
+            pdf_bytes = export_pdf(user.name, user.id, year, month, summary["salary"], version)
+            st.download_button(
+                "Download PDF Report",
+                pdf_bytes,
+                f"{year}-{month:02d}_report.pdf",
+                "application/pdf"
+            )
 
     # ---------------- LOGOUT ----------------
     elif menu == "Logout":
@@ -342,3 +489,4 @@ else:
         st.session_state.user = None
         st.rerun()
 
+Session.remove()